@@ -826,6 +826,9 @@ import redis
 import cv2
 import numpy as np
 import base64
+import json
+import struct
+import time
 from core.arduino_sender import send_to_arduino, \
     open_serial_connection, send_data, close_serial_connection, \
     find_port
@@ -874,6 +877,58 @@ def receive_signal(r, redis_key):      # ← имя параметра тепе
 def disconnect_redis(r):
     r.close()
 
+# Бинарная запись кадра: magic, порядковый номер, время захвата, затем JPEG как есть
+FRAME_MAGIC = b"RBF1"
+FRAME_HEADER = struct.Struct("!4sQd")
+
+def send_frame(r, redis_key, jpeg_bytes, seq, captured_at):
+    r.set(redis_key, FRAME_HEADER.pack(FRAME_MAGIC, seq, captured_at) + jpeg_bytes)
+
+# Команды приходят в поток user:{uid}:robot:commands и читаются через consumer group,
+# поэтому не теряются, пока воркер занят или переподключается.
+COMMAND_GROUP = "worker"
+ACK_TTL = 60
+COMMAND_MAX_AGE = 300       # сек: при первом запуске воркера выполняем команды не старше этого
+
+def ensure_command_group(r, stream):
+    # поток обычно уже создан веб-частью (XADD) до первого запуска воркера: группа с "$"
+    # пропустила бы эти команды, поэтому стартуем с id, соответствующего now - COMMAND_MAX_AGE
+    start_id = f"{int((time.time() - COMMAND_MAX_AGE) * 1000)}-0"
+    try:
+        r.xgroup_create(stream, COMMAND_GROUP, id=start_id, mkstream=True)
+    except redis.ResponseError as exc:
+        if "BUSYGROUP" not in str(exc):
+            raise
+
+def read_commands(r, stream, pending=False):
+    """[(command_id, command)]; pending=True — все выданные нам ранее, но не подтверждённые."""
+    if not pending:
+        resp = r.xreadgroup(COMMAND_GROUP, COMMAND_GROUP, {stream: ">"}, count=10)
+        return [(cmd_id, fields.get("cmd")) for _, msgs in resp for cmd_id, fields in msgs if fields]
+    # история PEL читается страницами: курсор — id последней полученной записи
+    commands, last_id = [], "0"
+    while True:
+        resp = r.xreadgroup(COMMAND_GROUP, COMMAND_GROUP, {stream: last_id}, count=100)
+        msgs = [m for _, batch in resp for m in batch]
+        if not msgs:
+            return commands
+        commands += [(cmd_id, fields.get("cmd")) for cmd_id, fields in msgs if fields]
+        last_id = msgs[-1][0]
+
+def send_heartbeat(r, heartbeat_key, events_key, state, ttl):
+    """Состояние воркера с TTL: веб берёт статус отсюда вместо systemctl."""
+    pipe = r.pipeline(transaction=False)
+    pipe.set(heartbeat_key, json.dumps(state), ex=ttl)
+    pipe.publish(events_key, json.dumps({"type": "pipeline", "data": {"status": state["state"]}}))
+    pipe.execute()
+
+def ack_command(r, stream, cmd_id, ack_key, status="ok"):
+    pipe = r.pipeline(transaction=False)
+    pipe.xack(stream, COMMAND_GROUP, cmd_id)
+    pipe.rpush(ack_key, status)          # веб ждёт его через BLPOP
+    pipe.expire(ack_key, ACK_TTL)
+    pipe.execute()
+
 def receive_realtime_signal_and_send_to_arduino(redis_keys):
     redis_conn = connect_redis(RedisHost, RedisPort, RedisPassword)
     arduino_port = find_port()
@@ -1255,11 +1310,13 @@ import numpy as np
 import time
 import base64
 import csv
+import json
 import os
 import glob
 import random
 from core.arduino_sender import open_serial_connection, close_serial_connection, send_data, command_to_send_to_arduino, find_port, receive_data
-from core.redis_processor import connect_redis, receive_signal, disconnect_redis, send_signal
+from core.redis_processor import connect_redis, receive_signal, disconnect_redis, send_signal, send_frame, \
+    ensure_command_group, read_commands, ack_command, send_heartbeat
 from processing.histogram_equalizer import histogram_equalization, histogram_equalization_on_frame
 from processing.adjust_brightness import adjust_brightness_on_frame, adjust_brightness_on_image
 from processing.correlation import extract_spectrum, extract_spectrum_on_frame, spectrum_to_see
@@ -1298,20 +1355,54 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
     RedisPassword = config_secret.RedisPassword
     redis_conn = connect_redis(RedisHost, RedisPort, RedisPassword)
     key = lambda name: f"user:{user_id}:{name}"
-    ps = redis_conn.pubsub(ignore_subscribe_messages=True)
-    ps.subscribe(key("robot:commands"))
+    commands = key("robot:commands")
+    ensure_command_group(redis_conn, commands)
 
 
+    last_error = None
     ARDUINO_URL = 'rfc2217://localhost:4000'
     try:
         ser = serial_for_url(ARDUINO_URL, baudrate=baud_rate, timeout=0.005)
         print(f"[Arduino] connected via {ARDUINO_URL}")
     except Exception as exc:
         print(f"[Arduino] connection failed: {exc}")
+        last_error = f"arduino: {exc}"
         ser = None
 
+    TELEMETRY_STREAM_LEN = 10000     # ≈ 3 ч строк Arduino, если stats_collector отстал
+    # Кольцевой буфер для графиков на дашборде: JSON [ts, *HISTORY_FIELDS],
+    # порядок полей должен совпадать с services.TELEMETRY_HISTORY_FIELDS
+    TELEMETRY_HISTORY_LEN = 3600     # ≈ 1 ч при строке в секунду
+    HISTORY_FIELDS = ('temperature', 'water', 'battery', 'sensor1')
+    last_line_at = None
+
+    def to_number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def store_telemetry(mapping, sample=None):
+        """Пишет телеметрию и уведомляет открытые дашборды (SSE) одним round trip.
+
+        `sample` дополнительно уходит в поток для stats_collector — без потерь —
+        и в кольцевой буфер истории (RPUSH + LTRIM, размер ограничен).
+        """
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hset(key('telemetry'), mapping=mapping)
+        if sample is not None:
+            pipe.xadd(key('telemetry:stream'), sample,
+                      maxlen=TELEMETRY_STREAM_LEN, approximate=True)
+            point = [round(time.time(), 1)] + [to_number(mapping.get(f)) for f in HISTORY_FIELDS]
+            pipe.rpush(key('telemetry:history'), json.dumps(point, separators=(',', ':')))
+            pipe.ltrim(key('telemetry:history'), -TELEMETRY_HISTORY_LEN, -1)
+        pipe.zadd('robots:active', {user_id: time.time()})   # реестр для stats_collector
+        pipe.publish(key('events'), json.dumps({'type': 'telemetry', 'data': mapping}))
+        pipe.execute()
+
     def poll_arduino_and_store():
         """Раз в цикл читаем строку CSV и кладём значения в Redis."""
+        nonlocal last_line_at
         if ser is None:
             return
         raw = ser.readline().decode(errors='ignore').strip()
@@ -1322,7 +1413,7 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
         except ValueError:
             print(f"[Arduino] bad line: {raw}")
             return
-        redis_conn.hset(key('telemetry'),mapping={
+        mapping = {
             'workTime'   : work,
             'temperature': temp,
             'sensor1'    : s1,
@@ -1332,7 +1423,12 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
             'water'      : water,
             'battery'    : batt,
             'moved'      : moved
-        })
+        }
+        # dt — сколько секунд действовала эта мощность (до 30 с после паузы)
+        now = time.time()
+        dt = min(now - last_line_at, 30.0) if last_line_at else 0.0
+        last_line_at = now
+        store_telemetry(mapping, sample={**mapping, 'dt': round(dt, 3)})
 
     load_reference_image = cv.imread(reference_image, cv.IMREAD_GRAYSCALE)
     reference_fourier_frame = spectrum_to_see(load_reference_image)
@@ -1362,6 +1458,7 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
         kalman.errorCovPost = np.array([[1]], dtype=np.float32)
         kalman.statePost = np.array([[0]], dtype=np.float32)
 
+        frame_seq = int(time.time() * 1000)   # монотонно растёт и между перезапусками
         frame_rate_limit = 10
         frame_interval = 1 / frame_rate_limit
         last_frame_time = time.time() - frame_interval
@@ -1374,10 +1471,29 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
         csvfile = open('data/processed/data_test.csv', 'w', newline='')
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow(['Timestamps', 'Values'])
+        HEARTBEAT_EVERY = 2     # сек
+        HEARTBEAT_TTL = 10      # сек: нет heartbeat дольше — веб считает воркер остановленным
+        last_heartbeat = 0.0
+        frames_sent = 0
+        cleaning_control = camera_control = None
+
+        # сначала то, что было выдано до перезапуска и не подтверждено
+        pending_commands = read_commands(redis_conn, commands, pending=True)
         while True:
-            msg = ps.get_message()
-            if msg and msg["type"] == "message":
-                cmd = msg["data"]           # строка, т.к. decode_responses=True
+            now = time.time()
+            if now - last_heartbeat >= HEARTBEAT_EVERY:
+                send_heartbeat(redis_conn, key("robot:heartbeat"), key("events"), {
+                    'state'     : 'running',
+                    'cleaning'  : cleaning_control == 'start',
+                    'camera'    : camera_control == 'on',
+                    'fps'       : round(frames_sent / (now - last_heartbeat), 1) if last_heartbeat else 0.0,
+                    'last_error': last_error,
+                    'ts'        : now,
+                }, HEARTBEAT_TTL)
+                last_heartbeat = now
+                frames_sent = 0
+
+            for cmd_id, cmd in pending_commands or read_commands(redis_conn, commands):
                 if cmd == "start_clean":
                     redis_conn.set(key("cleaning_control"), "start")
                     redis_conn.set(key("camera"), "on")
@@ -1387,6 +1503,8 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
                 elif cmd == "status":
                     # при желании отправьте статус обратно, например:
                     redis_conn.set(key("robot:state"), "running")
+                ack_command(redis_conn, commands, cmd_id, key(f"robot:ack:{cmd_id}"))
+            pending_commands = None
 
             cleaning_control = receive_signal(redis_conn, key("cleaning_control"))  # 'start' | 'stop' | None
             if cleaning_control == 'stop':
@@ -1424,9 +1542,9 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
                 camera_control = receive_signal(redis_conn, key("camera"))
                 if camera_control == "on":
                     _, img_encoded = cv.imencode('.jpg', frame)
-                    img_bytes = img_encoded.tobytes()
-                    img_base64 = base64.b64encode(img_bytes).decode("ascii")
-                    redis_conn.set(key("video"), f"1_{img_base64}_endframe")
+                    frame_seq += 1
+                    send_frame(redis_conn, key("frame"), img_encoded.tobytes(), frame_seq, current_time)
+                    frames_sent += 1
 
                     brightness_adjusted_frame = adjust_brightness_on_frame(frame, 100)
 
@@ -1457,7 +1575,7 @@ def Main_Run(user_id, reference_image, baud_rate, redis_receive_keys, arduino_da
 
                     TheCommand = predict_group(NMI_Score_filtered, mean_clean, std_clean, mean_dirty, std_dirty)
                     send_data(ser, baud_rate, TheCommand, 1)
-                    redis_conn.hset(key('telemetry'), mapping={'panelStatus': TheCommand})
+                    store_telemetry({'panelStatus': TheCommand})
                     print(f"NMI_Score: {NMI_Score_filtered:.2f}")
                     telemetry = redis_conn.hgetall(key('telemetry'))
                     print(f"T={telemetry.get('temperature')}°C "
@@ -1,7 +1,11 @@
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timezone
+import hashlib
 import json
 import shutil, os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
 from flask import (
@@ -12,18 +16,26 @@ from flask import (
     url_for,
     session,
     jsonify,
+    Response,
+    copy_current_request_context,
 )
 from models import UserSettings
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import text
 
 from config import Config
-from models import db, User, CleaningLog, EventLog
-from services import weather_forecast, publish_robot, chart_data
+from models import db, User, EventLog
+from services import weather_compact, publish_robot, wait_robot_ack, chart_data, CHART_MAX_POINTS
+from services import ACK_WAIT_MAX_MS
+from services import user_settings, invalidate_user_settings
+from services import telemetry_history, TELEMETRY_HISTORY_FIELDS, TELEMETRY_HISTORY_POINTS
 from stream import bp as stream_bp
 import subprocess
-from intelligent_planner import suggest_cleaning_time
-from event_logger import log_event
+from intelligent_planner import plan_cleaning_windows, cached_plan, TZ
+from event_logger import log_event, log_command, event_row
+import event_logger
+import events
+import weather
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -36,6 +48,7 @@ def inject_now():
     return {"datetime": datetime}
 
 db.init_app(app)
+event_logger.init_app(app)
 redis_conn = redis.from_url(app.config["REDIS_URL"], ssl_cert_reqs=None)
 
 def login_required(fn):
@@ -98,13 +111,27 @@ def dashboard() -> str:
 def api_weather():
     lat = request.args.get("lat", type=float)
     lon = request.args.get("lon", type=float)
-    forecast = weather_forecast(lat, lon)
-    return jsonify(forecast)
+    step  = max(1, min(request.args.get("step", 1, type=int), 24))
+    hours = request.args.get("hours", type=int)
+    hours = max(1, min(hours, 16 * 24)) if hours else None
+    return Response(weather_compact(lat, lon, step, hours, uid=session["user_id"]),
+                    mimetype="application/json")
+
+def _naive_utc(value) -> datetime:
+    # recorded_at хранится как naive UTC; "…+03:00" приводим к нему
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
 
 @app.route("/api/chart-data")
 @login_required
 def api_chart_data():
-    data = chart_data()
+    start = request.args.get("from", type=_naive_utc)
+    end   = request.args.get("to", type=_naive_utc)
+    max_points = request.args.get("max_points", CHART_MAX_POINTS, type=int)
+    data = chart_data(start, end, max(2, min(max_points, 5000)),
+                      request.args.get("downsample"))
     return jsonify(data)
 
 @app.route("/api/robot", methods=["POST"])
@@ -114,16 +141,18 @@ def api_robot():
     command = payload.get("command")
     if not command:
         return jsonify({"error": "command required"}), 400
-    publish_robot(redis_conn, command)
+    try:
+        wait_ms = max(0, min(int(payload.get("wait_ms") or 0), ACK_WAIT_MAX_MS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "wait_ms must be an integer"}), 400
+    # Redis: один EVALSHA (команда + желаемое состояние + аудит); SQL — фоновым writer'ом
+    command_id = publish_robot(redis_conn, command)
     log_event("INFO", "robot", f"command «{command}» sent")
-    log = CleaningLog(
-        user_id=session["user_id"],
-        command=command,
-        issued_at=datetime.utcnow(),
-    )
-    db.session.add(log)
-    db.session.commit()
-    return jsonify({"status": "ok"}), 200
+    log_command(session["user_id"], command)
+    resp = {"status": "ok", "command_id": command_id}
+    if wait_ms:
+        resp["acked"] = wait_robot_ack(redis_conn, command_id, wait_ms) is not None
+    return jsonify(resp), 200
 
 
 @app.route("/api/settings", methods=["GET", "PUT"])
@@ -132,9 +161,7 @@ def api_settings():
     uid = session["user_id"]
 
     if request.method == "GET":
-        s = UserSettings.query.get(uid)
-        return jsonify({"lat": s.lat if s else None,
-                        "lon": s.lon if s else None})
+        return jsonify(user_settings(uid))
 
     data = request.get_json(force=True)
     lat, lon = data.get("lat"), data.get("lon")
@@ -142,83 +169,229 @@ def api_settings():
     s = UserSettings.query.get(uid) or UserSettings(user_id=uid)
     s.lat, s.lon = lat, lon
     db.session.add(s)
-    db.session.execute(text("DELETE FROM weather_cache WHERE user_id=:uid"),
-        {"uid": uid})
     db.session.commit()
+    invalidate_user_settings(uid)
+    redis_conn.delete(f"user:{uid}:plan")      # план считался для старых координат
     return "", 204
 
+# Статус берётся из heartbeat воркера (user:{uid}:robot:heartbeat, с TTL), а не из
+# systemctl на каждый запрос; в пределах процесса ещё и кэшируется на секунду.
+STATUS_CACHE_TTL = 1.0
+JOB_TTL = 3600
+_status_cache: dict = {}
+_jobs = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pipeline-job")
+
+def _pipeline_state(uid) -> dict:
+    cached = _status_cache.get(uid)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.get(f"user:{uid}:robot:heartbeat")
+    pipe.get(f"user:{uid}:robot:state")
+    data = _decode_pipeline(*pipe.execute())
+    _status_cache[uid] = (time.monotonic() + STATUS_CACHE_TTL, data)
+    return data
+
+def _decode_pipeline(heartbeat, state) -> dict:
+    if heartbeat:
+        data = json.loads(heartbeat)
+        data["status"] = data.pop("state", "running")
+    else:
+        data = {"status": (state or b"inactive").decode()}
+    return data
+
+def _pipeline_status(uid) -> str:
+    return _pipeline_state(uid)["status"]
+
+def _run_pipeline_job(uid, job_id, action):
+    job = f"pipeline:job:{job_id}"
+    redis_conn.hset(job, "status", "running")
+    try:
+        if SYSTEMCTL is None:
+            redis_conn.set(f"user:{uid}:robot:state",
+                           "active" if action == "start" else "inactive",
+                           ex=30)
+        else:
+            subprocess.run([SYSTEMCTL, action, f"robot-worker@{uid}"],
+                           check=True, capture_output=True)
+        if action == "stop":
+            redis_conn.delete(f"user:{uid}:robot:heartbeat")
+        redis_conn.hset(job, "status", "done")
+    except Exception as exc:
+        redis_conn.hset(job, mapping={"status": "failed", "error": str(exc)[:200]})
+    _status_cache.pop(uid, None)
+    events.publish(redis_conn, uid, "pipeline", {"status": _pipeline_status(uid)})
+
 @app.route("/api/pipeline", methods=["POST"])
 @login_required
 def api_pipeline():
     action = request.json.get("action")
     uid    = session["user_id"]
-    svc    = f"robot-worker@{uid}"
-    if SYSTEMCTL is None:
-        if action == "status":
-            status = (redis_conn.get(f"user:{uid}:robot:state") or b"inactive").decode()
-            return jsonify({"status": status})
-        elif action in ("start", "stop"):
-            redis_conn.set(f"user:{uid}:robot:state",
-                           "active" if action == "start" else "inactive",
-                           ex=30)
-            return "", 204
+    if action == "status":
+        return jsonify(_pipeline_state(uid))
+    if action == "job":
+        job = redis_conn.hgetall(f"pipeline:job:{request.json.get('job_id')}")
+        if not job:
+            return jsonify(error="unknown job"), 404
+        return jsonify({k.decode(): v.decode() for k, v in job.items()})
+    if action not in ("start", "stop"):
         return jsonify(error="unknown action"), 400
 
-    if action == "start":
-        subprocess.run([SYSTEMCTL, "start",svc], check=True)
-    elif action == "stop":
-        subprocess.run([SYSTEMCTL, "stop",svc], check=True)
-    elif action == "status":
-        out = subprocess.check_output([SYSTEMCTL, "is-active", svc]).decode().strip()
-        return jsonify({"status": out})
-    else:
-        return jsonify(error="unknown action"), 400
-    return "", 204
+    # systemctl может идти секундами — запускаем в фоне и сразу отдаём id задания
+    job_id = uuid.uuid4().hex
+    redis_conn.hset(f"pipeline:job:{job_id}", mapping={"action": action, "status": "queued"})
+    redis_conn.expire(f"pipeline:job:{job_id}", JOB_TTL)
+    _jobs.submit(_run_pipeline_job, uid, job_id, action)
+    return jsonify({"job_id": job_id}), 202
 
-@app.route("/api/telemetry")
-@login_required
-def api_telemetry():
-    uid = session["user_id"]
-    k = lambda name: f"user:{uid}:{name}"
-    data = redis_conn.hgetall(k("telemetry"))
+def _telemetry(uid) -> dict:
+    return _decode_telemetry(redis_conn.hgetall(f"user:{uid}:telemetry"))
 
+def _decode_telemetry(data) -> dict:
     # декодируем Redis hash целиком
     decoded = {k.decode(): v.decode() for k, v in data.items()}
 
     # если поле battery отсутствует, добавим заглушку
     if "battery" not in decoded:
         decoded["battery"] = "100"
+    return decoded
 
-    return jsonify(decoded)
+@app.route("/api/telemetry")
+@login_required
+def api_telemetry():
+    return jsonify(_telemetry(session["user_id"]))
 
+@app.route("/api/telemetry/history")
+@login_required
+def api_telemetry_history():
+    # ?field=battery&since=<unix-время>&max_points=N — последний час из памяти Redis
+    field = request.args.get("field", "battery")
+    if field not in TELEMETRY_HISTORY_FIELDS:
+        return jsonify(error="unknown field", fields=TELEMETRY_HISTORY_FIELDS), 400
+    max_points = request.args.get("max_points", TELEMETRY_HISTORY_POINTS, type=int)
+    return jsonify(telemetry_history(redis_conn, session["user_id"], field,
+                                     since=request.args.get("since", type=float),
+                                     max_points=max(2, min(max_points, 3600))))
+
+@app.route("/api/events")
+@login_required
+def api_events():
+    # SSE вместо опроса: телеметрия, статус пайплайна и новые записи журнала
+    uid = session["user_id"]
+    gen = events.stream(uid, _telemetry(uid), {"status": _pipeline_status(uid)},
+                        lambda: {"status": _pipeline_status(uid)})
+    return Response(gen, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
 
 
+
+def _best_time(uid) -> dict:
+    windows = cached_plan(uid)
+    if windows is None:
+        settings = user_settings(uid)
+        windows = plan_cleaning_windows(uid, settings["lat"], settings["lon"])
+    if not windows:
+        return {"best_time": "Немає безпечного вікна в найближчі 48 год.",
+                "windows": []}
+    t = datetime.fromtimestamp(windows[0]["start"], TZ)
+    return {"best_time": t.strftime("%d %b %Y %H:%M"), "windows": windows}
+
 @app.route("/api/best_cleaning_time")
 @login_required
 def best_cleaning_time():
-    uid = session["user_id"]
-    settings = UserSettings.query.get(uid)
-    t = suggest_cleaning_time(settings.lat, settings.lon)
-    if t is None:
-        return jsonify(best_time="Немає безпечного вікна в найближчі 48 год.")
-    return jsonify(best_time=t.strftime("%d %b %Y %H:%M"))
+    return jsonify(_best_time(session["user_id"]))
+
+def _event_logs(uid, before_id=None, since_id=None, limit=100):
+    # OR по nullable user_id не ложится на индекс — два диапазона по (user_id, id)
+    rows = []
+    for cond in (EventLog.user_id == uid, EventLog.user_id.is_(None)):
+        q = EventLog.query.filter(cond)
+        if since_id is not None:
+            q = q.filter(EventLog.id > since_id).order_by(EventLog.id.asc())
+        else:
+            if before_id is not None:
+                q = q.filter(EventLog.id < before_id)
+            q = q.order_by(EventLog.id.desc())
+        rows += q.limit(limit).all()
+    if since_id is not None:
+        # самые старые из новых — чтобы следующий since_id не пропустил записи
+        rows = sorted(rows, key=lambda r: r.id)[:limit][::-1]
+    else:
+        rows = sorted(rows, key=lambda r: r.id, reverse=True)[:limit]
+    return rows
 
 @app.route("/api/event-log")
 @login_required
 def api_event_log():
-    # Отдаём последние 100 событий ТОЛЬКО текущего пользователя + системные (NULL)
+    # События ТОЛЬКО текущего пользователя + системные (NULL), новые сверху.
+    # ?before_id=N — страница старше N, ?since_id=N — только появившиеся после N.
     uid   = session["user_id"]
-    rows  = (EventLog.query
-              .filter((EventLog.user_id == uid) | (EventLog.user_id == None))
-              .order_by(EventLog.created_at.desc())
-              .limit(100)
-              .all())
-    return jsonify([{
-        "ts":   row.created_at.strftime("%d.%m %H:%M:%S"),
-        "lvl":  row.level,
-        "comp": row.component,
-        "msg":  row.message[:140]  # короче для фронта
-    } for row in rows])
+    limit = max(1, min(request.args.get("limit", 100, type=int), 500))
+    rows  = _event_logs(uid,
+                        before_id=request.args.get("before_id", type=int),
+                        since_id=request.args.get("since_id", type=int),
+                        limit=limit)
+    return jsonify([event_row(row) for row in rows])
+
+# Начальное состояние дашборда одним запросом. Сначала дешёвая версия (запись прогноза
+# из кэша, Redis pipeline, один SELECT по индексам); совпала с If-None-Match — 304
+# без сбора документа. Иначе в пул уходит только планировщик (может считать окна
+# и ходить за профилем выработки), а дешёвые части идут в потоке запроса, пока он
+# работает. Одна задача на загрузку — пул не становится общей очередью.
+DASHBOARD_WEATHER = {"step": 3, "hours": 24}
+DASHBOARD_CHART_POINTS = 300
+_dashboard = ThreadPoolExecutor(max_workers=32, thread_name_prefix="dashboard-state")
+
+def _dashboard_version(uid, settings):
+    # версия прогноза — fetched_at той самой записи, которая уйдёт в документ
+    forecast = weather.forecast_entry(settings["lat"] or Config.WEATHER_LAT,
+                                      settings["lon"] or Config.WEATHER_LON)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hgetall(f"user:{uid}:telemetry")
+    pipe.get(f"user:{uid}:robot:heartbeat")
+    pipe.get(f"user:{uid}:robot:state")
+    pipe.get(f"user:{uid}:plan")
+    telemetry, heartbeat, state, plan = pipe.execute()
+
+    # новые записи журнала и новая корзина выработки
+    # (досуммирование в последнюю корзину версию не меняет — до следующей корзины)
+    own_log, system_log, last_energy = db.session.execute(
+        text("""SELECT (SELECT MAX(id) FROM event_logs WHERE user_id = :uid),
+                       (SELECT MAX(id) FROM event_logs WHERE user_id IS NULL),
+                       (SELECT MAX(recorded_at) FROM energy_stats WHERE user_id = :uid)"""),
+        {"uid": uid},
+    ).one()
+
+    # в документ и версию попадает только статус: fps/ts из heartbeat менялись бы каждые 2 с
+    known = {
+        "settings":  settings,
+        "telemetry": _decode_telemetry(telemetry),
+        "pipeline":  {"status": _decode_pipeline(heartbeat, state)["status"]},
+    }
+    version = [known, forecast["fetched_at"], own_log, system_log, str(last_energy),
+               hashlib.sha1(plan).hexdigest() if plan else None]
+    etag = hashlib.sha1(json.dumps(version, sort_keys=True).encode()).hexdigest()
+    return etag, known, forecast
+
+@app.route("/api/dashboard-state")
+@login_required
+def api_dashboard_state():
+    uid = session["user_id"]
+    settings = user_settings(uid)
+    etag, result, forecast = _dashboard_version(uid, settings)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        best_time = _dashboard.submit(copy_current_request_context(lambda: _best_time(uid)))
+        result["weather"] = json.loads(weather.compact(forecast, **DASHBOARD_WEATHER))
+        result["chart"] = chart_data(max_points=DASHBOARD_CHART_POINTS, downsample="lttb")
+        result["event_log"] = [event_row(row) for row in _event_logs(uid)]
+        result["best_time"] = best_time.result()
+        resp = jsonify(result)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.set_etag(etag)
+    return resp
 
 # @app.route("/api/telemetry")
 # @login_required
@@ -0,0 +1,18 @@
+import time
+from sqlalchemy import create_engine
+from config import Config
+from event_logger import prune_event_logs
+
+engine = create_engine(Config.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True, future=True)
+
+INTERVAL = 3600
+
+# Держит event_logs в пределах сроков хранения (event_logger.RETENTION_DAYS),
+# чтобы вставка и выборка журнала не деградировали со временем.
+while True:
+    started = time.monotonic()
+    deleted = prune_event_logs(engine)
+    if deleted:
+        print(f"[event_log_pruner] deleted {deleted} row(s) "
+              f"in {time.monotonic() - started:.1f}s")
+    time.sleep(INTERVAL)
@@ -1,15 +1,150 @@
 # utils/event_logger.py  (новый файл)
-from datetime import datetime
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
 from flask import session
-from models import db, EventLog
+from sqlalchemy import bindparam, text
+from models import db, EventLog, CleaningLog
+import events
+
+# Записи (event_logs и cleaning_logs) копятся в очереди и пишутся фоновым потоком
+# пачками (multi-row INSERT), так что запрос не ждёт commit в БД.
+QUEUE_SIZE  = 10000
+FLUSH_MS    = 200          # не реже, чем раз в столько мс ...
+FLUSH_BATCH = 500          # ... или как только набралось столько записей
+FULL_POLICY = "drop"       # очередь полна: "drop" — отбросить и посчитать, "flush" — записать сразу
+
+stats = {"written": 0, "dropped": 0, "failed": 0}
+
+# Сколько дней хранить записи каждого уровня; остальные уровни — DEFAULT_RETENTION_DAYS
+RETENTION_DAYS = {"INFO": 7, "WARN": 30, "ERROR": 90}
+DEFAULT_RETENTION_DAYS = 30
+PRUNE_BATCH = 5000         # строк за один DELETE — короткие транзакции без долгих блокировок
+
+_queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+_app = None
+
+
+def init_app(app):
+    """Запускает фоновый writer; при завершении процесса очередь дописывается."""
+    global _app
+    _app = app
+    threading.Thread(target=_writer, daemon=True, name="event-log-writer").start()
+    atexit.register(flush)
+
+
+def event_row(row: EventLog) -> dict:
+    return {
+        "id":   row.id,
+        "ts":   row.created_at.strftime("%d.%m %H:%M:%S"),
+        "lvl":  row.level,
+        "comp": row.component,
+        "msg":  row.message[:140]  # короче для фронта
+    }
+
+
+def _write(batch):
+    """batch — [(таблица, строка)]; все таблицы пишутся в одной транзакции."""
+    by_table = {}
+    for table, row in batch:
+        by_table.setdefault(table, []).append(row)
+    try:
+        with _app.app_context():
+            for table, rows in by_table.items():
+                db.session.execute(table.insert(), rows)
+            db.session.commit()
+        stats["written"] += len(batch)
+    except Exception as exc:
+        stats["failed"] += len(batch)
+        print(f"[event_logger] failed to write {len(batch)} row(s): {exc}")
+        return
+
+    # id у вставленных строк нет — дашборды сами дочитают ?since_id=<последний>
+    try:
+        pipe = events.redis_conn.pipeline(transaction=False)
+        for uid in {r["user_id"] for r in by_table.get(EventLog.__table__, [])}:
+            events.publish(pipe, uid, "log", {})
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def _writer():
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + FLUSH_MS / 1000
+        while len(batch) < FLUSH_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        _write(batch)
+
+
+def flush():
+    """Синхронно дописывает всё, что осталось в очереди."""
+    batch = []
+    while True:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch and _app is not None:
+        _write(batch)
+
+
+def _enqueue(table, row):
+    try:
+        _queue.put_nowait((table, row))
+    except queue.Full:
+        if FULL_POLICY == "flush" and _app is not None:
+            _write([(table, row)])
+        else:
+            stats["dropped"] += 1
+
 
 def log_event(level: str, component: str, msg: str, user_id: int | None = None):
-    """Пишет запись в event_logs и не ломает приложение даже при ошибке."""
+    """Ставит запись в очередь event_logs и не ломает приложение даже при ошибке."""
     try:
         uid = user_id if user_id is not None else session.get("user_id")
-        db.session.add(EventLog(
-            user_id=uid, level=level.upper(), component=component, message=msg,
-            created_at=datetime.utcnow()))
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
+    except RuntimeError:
+        uid = None              # вне запроса — системное событие
+    _enqueue(EventLog.__table__,
+             {"user_id": uid, "level": level.upper(), "component": component,
+              "message": msg, "created_at": datetime.utcnow()})
+
+
+def log_command(user_id: int, command: str):
+    """Строка cleaning_logs для отправленной команды — тем же фоновым writer'ом."""
+    _enqueue(CleaningLog.__table__,
+             {"user_id": user_id, "command": command, "issued_at": datetime.utcnow()})
+
+
+def prune_event_logs(engine, now=None) -> int:
+    """Удаляет записи старше срока хранения их уровня пачками по PRUNE_BATCH."""
+    now = now or datetime.utcnow()
+    rules = [("level = :lvl", {"lvl": lvl}, days) for lvl, days in RETENTION_DAYS.items()]
+    rules.append(("level NOT IN :known", {"known": list(RETENTION_DAYS)},
+                  DEFAULT_RETENTION_DAYS))
+
+    deleted = 0
+    for cond, params, days in rules:
+        stmt = text(f"""DELETE FROM event_logs
+                        WHERE {cond} AND created_at < :cutoff
+                        ORDER BY created_at
+                        LIMIT :batch""")
+        if "known" in params:
+            stmt = stmt.bindparams(bindparam("known", expanding=True))
+        while True:
+            with engine.begin() as c:
+                n = c.execute(stmt, {**params, "cutoff": now - timedelta(days=days),
+                                     "batch": PRUNE_BATCH}).rowcount
+            deleted += n
+            if n < PRUNE_BATCH:
+                break
+    return deleted
@@ -0,0 +1,114 @@
+import json
+import queue
+import threading
+
+import redis
+from config import Config
+
+redis_conn = redis.from_url(Config.REDIS_URL, ssl_cert_reqs=None)
+
+SYSTEM_CHANNEL = "system:events"
+KEEPALIVE = 15          # сек между комментариями-пингами в SSE
+_QUEUE_SIZE = 256
+
+_hubs: dict = {}
+_lock = threading.Lock()
+
+
+def channel(uid) -> str:
+    return f"user:{uid}:events"
+
+
+def publish(conn, uid, kind: str, data) -> None:
+    """Рассылает событие всем открытым дашбордам пользователя (uid=None — всем)."""
+    conn.publish(channel(uid) if uid is not None else SYSTEM_CHANNEL,
+                 json.dumps({"type": kind, "data": data}, ensure_ascii=False))
+
+
+class _UserHub:
+    """Одна подписка Redis на пользователя, раздаёт сообщения всем его вкладкам."""
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.listeners: set[queue.Queue] = set()
+        self._pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(channel(uid), SYSTEM_CHANNEL)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            while True:
+                with _lock:
+                    if not self.listeners:
+                        if _hubs.get(self.uid) is self:
+                            del _hubs[self.uid]
+                        return
+                    targets = list(self.listeners)
+                msg = self._pubsub.get_message(timeout=1.0)
+                if not msg:
+                    continue
+                for q in targets:
+                    try:
+                        q.put_nowait(msg["data"])
+                    except queue.Full:
+                        pass        # медленный клиент: дельты догонит следующим событием
+        finally:
+            self._pubsub.close()
+
+
+def subscribe(uid) -> queue.Queue:
+    q = queue.Queue(maxsize=_QUEUE_SIZE)
+    with _lock:
+        hub = _hubs.get(uid)
+        if hub is None:
+            hub = _hubs[uid] = _UserHub(uid)
+        hub.listeners.add(q)
+    return q
+
+
+def unsubscribe(uid, q: queue.Queue) -> None:
+    with _lock:
+        hub = _hubs.get(uid)
+        if hub is not None:
+            hub.listeners.discard(q)
+
+
+def _sse(kind: str, data) -> str:
+    return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream(uid, telemetry: dict, pipeline: dict, pipeline_fn=None):
+    """Генератор SSE: сначала снимок состояния, дальше только изменения.
+
+    pipeline_fn перечитывает статус на каждом keepalive: heartbeat воркера
+    истекает молча, без события.
+    """
+    q = subscribe(uid)
+    try:
+        yield _sse("telemetry", telemetry)
+        yield _sse("pipeline", pipeline)
+        while True:
+            try:
+                raw = q.get(timeout=KEEPALIVE)
+            except queue.Empty:
+                current = pipeline_fn() if pipeline_fn else pipeline
+                if current != pipeline:
+                    pipeline = current
+                    yield _sse("pipeline", pipeline)
+                else:
+                    yield ": keepalive\n\n"
+                continue
+            event = json.loads(raw)
+            kind, data = event["type"], event["data"]
+            if kind == "telemetry":
+                data = {k: v for k, v in data.items() if telemetry.get(k) != v}
+                if not data:
+                    continue
+                telemetry.update(data)
+            elif kind == "pipeline":
+                if data == pipeline:
+                    continue
+                pipeline = data
+            yield _sse(kind, data)
+    finally:
+        unsubscribe(uid, q)
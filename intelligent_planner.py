@@ -1,27 +1,202 @@
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from services import weather_forecast
+import json
+import time
+
+import numpy as np
+from sqlalchemy import bindparam, text
+
+from config import Config
+from models import db
+import weather
 
 
 TZ = ZoneInfo("Europe/Kyiv")
 
+HORIZON_HOURS = 48         # на сколько часов вперёд ищем окна
+DURATION_HOURS = 2         # длительность одной мойки
+TOP_K = 3
+PRECIP_LIMIT = 10          # %, при большей вероятности осадков окно отбрасываем
+TEMP_RANGE = (5.0, 35.0)   # °C: вне диапазона вода замерзает / быстро сохнет с разводами
+PROFILE_DAYS = 7           # по скольким дням считаем типичную выработку по часам
 
-def suggest_cleaning_time(lat=None, lon=None):
-    data = weather_forecast(lat, lon)
-    now = datetime.now(TZ)
+# веса слагаемых оценки (меньше — лучше)
+W_PRECIP = 1.0
+W_TEMP = 0.1
+W_LOST = 2.0
 
-    times = data["hourly"]["time"]
-    pops = data["hourly"]["precipitation_probability"]
 
-    for i in range(min(len(times), 48)):
-        t = datetime.fromisoformat(times[i]).replace(tzinfo=TZ)
-        if t < now:
-            continue
-        if pops[i] >= 10:
-            continue
-        if 6 <= t.hour < 18:
+def _to_arrays(data) -> dict:
+    """Прогноз → numpy-массивы; строится один раз на версию прогноза."""
+    hourly = data["hourly"]
+    local = np.array(hourly["time"], dtype="datetime64[s]")
+    # время в прогнозе локальное (TZ); смещение берём один раз — для 48 ч этого достаточно
+    offset = int(datetime.now(TZ).utcoffset().total_seconds())
+    epoch = local.astype(np.int64) - offset
+    return {
+        "epoch": epoch,
+        "utc_hour": (epoch // 3600) % 24,
+        "local_hour": (local.astype(np.int64) // 3600) % 24,
+        "precip": np.array(hourly["precipitation_probability"], dtype=float),
+        "temp": np.array(hourly["temperature_2m"], dtype=float),
+    }
+
+
+def _arrays(entry) -> dict:
+    if "arrays" not in entry:
+        entry["arrays"] = _to_arrays(entry["data"])
+    return entry["arrays"]
+
+
+def energy_profile(conn, user_ids, days=PROFILE_DAYS) -> dict:
+    """{user_id: массив[24] средней выработки кВт·ч по часам UTC} из почасовой свёртки."""
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = conn.execute(
+        text("""SELECT user_id, HOUR(recorded_at) AS h,
+                       SUM(energy_generated_kwh) / COUNT(DISTINCT DATE(recorded_at))
+                FROM energy_stats_hourly
+                WHERE user_id IN :uids AND recorded_at >= :since
+                GROUP BY user_id, h""").bindparams(bindparam("uids", expanding=True)),
+        {"uids": list(user_ids), "since": since},
+    ).all()
+    profiles = {}
+    for uid, hour, kwh in rows:
+        profiles.setdefault(uid, np.zeros(24))[hour] = float(kwh)
+    return profiles
+
+
+def score_windows(arrays, profile=None, now=None, top_k=TOP_K,
+                  duration=DURATION_HOURS, horizon=HORIZON_HOURS) -> list[dict]:
+    """Оценивает все окна длительностью `duration` ч и возвращает top_k непересекающихся.
+
+    Оценка = осадки + выход температуры за TEMP_RANGE + ожидаемая потеря выработки
+    (по профилю пользователя; без профиля — светлое время 06–18 считается потерей).
+    """
+    now = now or datetime.now(timezone.utc)
+    epoch = arrays["epoch"]
+    n = len(epoch) - duration + 1
+    if n <= 0:
+        return []
+    win = lambda a: np.lib.stride_tricks.sliding_window_view(a, duration)[:n]
+
+    precip = win(arrays["precip"]).max(axis=1)
+    lo, hi = TEMP_RANGE
+    temp = arrays["temp"]
+    temp_pen = win(np.clip(lo - temp, 0, None) + np.clip(temp - hi, 0, None)).sum(axis=1)
+    if profile is not None and profile.any():
+        lost = win(profile[arrays["utc_hour"]]).sum(axis=1)
+        lost_norm = lost / max(profile.max() * duration, 1e-9)
+    else:
+        daylight = ((arrays["local_hour"] >= 6) & (arrays["local_hour"] < 18)).astype(float)
+        lost_norm = win(daylight).sum(axis=1) / duration
+        lost = np.zeros(n)
+
+    score = W_PRECIP * precip / 100 + W_TEMP * temp_pen + W_LOST * lost_norm
+    start = epoch[:n]
+    now_ts = now.timestamp()
+    ok = (start >= now_ts) & (start < now_ts + horizon * 3600) & (precip < PRECIP_LIMIT)
+
+    windows, taken = [], np.zeros(len(epoch), dtype=bool)
+    for i in np.argsort(np.where(ok, score, np.inf), kind="stable"):
+        if not ok[i] or len(windows) >= top_k:
+            break
+        if taken[i:i + duration].any():
             continue
-        return t
+        taken[i:i + duration] = True
+        windows.append({
+            "start": int(start[i]),
+            "end": int(start[i]) + duration * 3600,
+            "score": round(float(score[i]), 4),
+            "precipitation": float(precip[i]),
+            "lost_kwh": round(float(lost[i]), 4),
+        })
+    return windows
+
+
+PLAN_TTL = 6 * 3600
+
 
-    return None
+def _plan_key(uid) -> str:
+    return f"user:{uid}:plan"
+
+
+def _upcoming(windows) -> list[dict]:
+    now = datetime.now(timezone.utc).timestamp()
+    return [w for w in windows if w["start"] >= now]
+
+
+def _fresh(plan):
+    """Ещё актуальные окна плана; None, если все посчитанные окна уже прошли.
+
+    Пустой план (нет безопасных окон) — тоже валидный результат, а не промах.
+    """
+    windows = _upcoming(plan["windows"])
+    return windows if windows or not plan["windows"] else None
+
+
+def cached_plan(uid):
+    """Окна, заранее посчитанные plan_fleet (или прошлым запросом); None, если нет."""
+    raw = weather.redis_conn.get(_plan_key(uid))
+    if not raw:
+        return None
+    return _fresh(json.loads(raw))
+
+
+def plan_cleaning_windows(uid, lat=None, lon=None, conn=None) -> list[dict]:
+    """Лучшие окна для мойки; результат кэшируется в Redis на версию прогноза."""
+    lat = lat or Config.WEATHER_LAT
+    lon = lon or Config.WEATHER_LON
+    entry = weather.forecast_entry(lat, lon)
+
+    raw = weather.redis_conn.get(_plan_key(uid))
+    if raw:
+        plan = json.loads(raw)
+        windows = _fresh(plan)
+        if plan["version"] == entry["fetched_at"] and windows is not None:
+            return windows
+
+    profile = energy_profile(conn or db.session, [uid]).get(uid)
+    windows = score_windows(_arrays(entry), profile)
+    weather.redis_conn.set(_plan_key(uid),
+                           json.dumps({"version": entry["fetched_at"], "windows": windows}),
+                           ex=PLAN_TTL)
+    return windows
+
+
+def plan_fleet(conn) -> dict:
+    """Считает окна для всех пользователей с координатами; прогноз — один раз на клетку."""
+    started = time.monotonic()
+    rows = conn.execute(text("""SELECT user_id, lat, lon FROM user_settings
+                                WHERE lat IS NOT NULL AND lon IS NOT NULL""")).all()
+    cells = defaultdict(list)
+    for uid, lat, lon in rows:
+        cells[weather.cell(lat, lon)].append(uid)
+
+    profiles = {}
+    uids = [uid for uid, _, _ in rows]
+    for i in range(0, len(uids), 1000):
+        profiles.update(energy_profile(conn, uids[i:i + 1000]))
+
+    planned = failed = 0
+    for c, users in cells.items():
+        try:
+            entry = weather.forecast_entry(*c)
+        except Exception as exc:
+            print(f"[planner] forecast for {c} failed: {exc}")
+            failed += len(users)
+            continue
+        arrays = _arrays(entry)
+        pipe = weather.redis_conn.pipeline(transaction=False)
+        for uid in users:
+            windows = score_windows(arrays, profiles.get(uid))
+            pipe.set(_plan_key(uid),
+                     json.dumps({"version": entry["fetched_at"], "windows": windows}),
+                     ex=PLAN_TTL)
+        pipe.execute()
+        planned += len(users)
 
+    report = {"finished_at": int(time.time()), "users": planned, "failed": failed,
+              "cells": len(cells), "duration_ms": round((time.monotonic() - started) * 1000, 1)}
+    weather.redis_conn.hset("planner:last_run", mapping=report)
+    return report
@@ -32,6 +32,9 @@ class UserSettings(db.Model):
 
 class EnergyStat(db.Model):
     __tablename__ = "energy_stats"
+    # нужен для ON DUPLICATE KEY в stats_collector и для выборок по диапазону времени
+    __table_args__ = (db.UniqueConstraint("user_id", "recorded_at",
+                                          name="uq_energy_stats_user_ts"),)
     id                   = db.Column(db.BigInteger, primary_key=True)
     user_id              = db.Column(db.Integer,
                                      db.ForeignKey("users.id", ondelete="CASCADE"),
@@ -42,6 +45,28 @@ class EnergyStat(db.Model):
     user                 = db.relationship("User", back_populates="energy_stats")
 
 
+class EnergyStatHourly(db.Model):
+    """Сумма energy_stats за час; ведётся stats_collector в той же транзакции."""
+    __tablename__ = "energy_stats_hourly"
+    user_id              = db.Column(db.Integer,
+                                     db.ForeignKey("users.id", ondelete="CASCADE"),
+                                     primary_key=True)
+    recorded_at          = db.Column(db.DateTime, primary_key=True)
+    energy_generated_kwh = db.Column(db.Numeric(14, 6), default=0)
+    energy_saved_kwh     = db.Column(db.Numeric(14, 6), default=0)
+
+
+class EnergyStatDaily(db.Model):
+    """Сумма energy_stats за сутки (UTC)."""
+    __tablename__ = "energy_stats_daily"
+    user_id              = db.Column(db.Integer,
+                                     db.ForeignKey("users.id", ondelete="CASCADE"),
+                                     primary_key=True)
+    recorded_at          = db.Column(db.DateTime, primary_key=True)
+    energy_generated_kwh = db.Column(db.Numeric(14, 6), default=0)
+    energy_saved_kwh     = db.Column(db.Numeric(14, 6), default=0)
+
+
 class CleaningLog(db.Model):
     __tablename__ = "cleaning_logs"
 
@@ -60,11 +85,15 @@ class CleaningLog(db.Model):
 # models.py  (добавьте после CleaningLog)
 class EventLog(db.Model):
     __tablename__ = "event_logs"
+    # под /api/event-log: WHERE user_id = ? (или IS NULL) ORDER BY id DESC / id > since_id;
+    # (level, created_at) — под пачечное удаление по сроку хранения
+    __table_args__ = (db.Index("ix_event_logs_user_id_id", "user_id", "id"),
+                      db.Index("ix_event_logs_level_created_at", "level", "created_at"))
 
     id         = db.Column(db.BigInteger, primary_key=True)
     user_id    = db.Column(db.Integer,
                            db.ForeignKey("users.id", ondelete="SET NULL"),
-                           nullable=True, index=True)
+                           nullable=True)
     level      = db.Column(db.String(5),  nullable=False)   # INFO/WARN/ERROR
     component  = db.Column(db.String(32), nullable=False)
     message    = db.Column(db.Text,       nullable=False)
@@ -0,0 +1,17 @@
+import time
+from sqlalchemy import create_engine
+from config import Config
+from intelligent_planner import plan_fleet
+
+engine = create_engine(Config.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True, future=True)
+
+INTERVAL = 15 * 60
+
+# Заранее считает окна мойки для всех пользователей, чтобы
+# /api/best_cleaning_time сводился к одному GET из Redis.
+while True:
+    with engine.connect() as conn:
+        report = plan_fleet(conn)
+    print(f"[planner] planned {report['users']} user(s) in {report['cells']} cell(s) "
+          f"in {report['duration_ms']} ms, failed {report['failed']}")
+    time.sleep(INTERVAL)
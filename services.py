@@ -1,98 +1,244 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
-import requests
+import time
 from sqlalchemy.sql import text
 import math
 from config import Config
+import weather
 from models import db
 from models import UserSettings
-from flask import session
+from flask import session, g, has_app_context
 from datetime import datetime, timedelta
 
 
-def weather_forecast(lat=None, lon=None):
-    uid = session["user_id"]
-    settings = UserSettings.query.get(uid)
-
-    lat = lat or settings.lat or Config.WEATHER_LAT
-    lon = lon or settings.lon or Config.WEATHER_LON
-
-    row = db.session.execute(
-        text("""SELECT payload, fetched_at
-                FROM weather_cache
-                WHERE user_id = :uid AND lat = :lat AND lon = :lon"""),
-        {"uid": uid, "lat": lat, "lon": lon},
-    ).first()
-
-    if row and datetime.utcnow() - row.fetched_at < timedelta(minutes=30):
-        return json.loads(row.payload)
-
-    url = Config.WEATHER_API_URL.format(lat=lat, lon=lon)
-    params = {"apikey": Config.WEATHER_API_KEY} if Config.WEATHER_API_KEY else {}
-    data = requests.get(url, params=params, timeout=5).json()
-
-    db.session.execute(
-        text("""INSERT INTO weather_cache (user_id, lat, lon, fetched_at, payload)
-                VALUES (:uid, :lat, :lon, :ts, :payload)
-                ON DUPLICATE KEY UPDATE fetched_at = :ts, payload = :payload"""),
-        {"uid": uid, "lat": lat, "lon": lon,
-         "ts": datetime.utcnow(), "payload": json.dumps(data)},
-    )
-    db.session.commit()
+SETTINGS_TTL = 3600
+
+
+def _settings_key(uid) -> str:
+    return f"user:{uid}:settings"
+
+
+def user_settings(uid) -> dict:
+    """{"lat", "lon"} пользователя: g (в пределах запроса) → Redis → БД."""
+    memo = g.setdefault("user_settings", {}) if has_app_context() else {}
+    if uid in memo:
+        return memo[uid]
+    raw = weather.redis_conn.get(_settings_key(uid))
+    if raw:
+        data = json.loads(raw)
+    else:
+        s = db.session.get(UserSettings, uid)
+        # Numeric → Decimal: в JSON и в ответах из кэша — float
+        data = {"lat": float(s.lat) if s and s.lat is not None else None,
+                "lon": float(s.lon) if s and s.lon is not None else None}
+        weather.redis_conn.set(_settings_key(uid), json.dumps(data), ex=SETTINGS_TTL)
+    memo[uid] = data
     return data
 
 
+def invalidate_user_settings(uid) -> None:
+    weather.redis_conn.delete(_settings_key(uid))
+    if has_app_context():
+        g.setdefault("user_settings", {}).pop(uid, None)
+
+
+def _location(lat=None, lon=None, uid=None):
+    """Явные координаты → координаты пользователя uid → значения по умолчанию."""
+    if (lat is None or lon is None) and uid is not None:
+        settings = user_settings(uid)
+        lat = lat or settings["lat"]
+        lon = lon or settings["lon"]
+    return lat or Config.WEATHER_LAT, lon or Config.WEATHER_LON
+
+
+def weather_compact(lat=None, lon=None, step=1, hours=None, uid=None) -> bytes:
+    """Сжатая проекция прогноза для дашборда — уже сериализованный JSON."""
+    return weather.forecast_compact(*_location(lat, lon, uid), step, hours)
+
+
+
+COMMAND_STREAM_LEN = 1000      # команд в потоке робота (approximate MAXLEN)
+AUDIT_STREAM_LEN = 10000
+ACK_WAIT_MAX_MS = 5000
+
+# Команда, желаемое состояние робота и запись аудита — атомарно и за один round trip.
+# KEYS: поток команд, hash желаемого состояния, поток аудита
+# ARGV: команда, ts, MAXLEN команд, MAXLEN аудита, user_id
+_COMMAND_LUA = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'cmd', ARGV[1], 'ts', ARGV[2])
+redis.call('HSET', KEYS[2], 'command', ARGV[1], 'command_id', id, 'ts', ARGV[2])
+redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*',
+           'user_id', ARGV[5], 'cmd', ARGV[1], 'command_id', id, 'ts', ARGV[2])
+return id
+"""
+_command_script = None
 
-def publish_robot(conn, command):
+
+def publish_robot(conn, command) -> str:
+    """Кладёт команду в поток робота; возвращает её id (id записи потока)."""
+    global _command_script
+    if _command_script is None:
+        _command_script = conn.register_script(_COMMAND_LUA)
     uid = session["user_id"]
-    conn.publish(f"user:{uid}:robot:commands", command)
+    cmd_id = _command_script(
+        keys=[f"user:{uid}:robot:commands",
+              f"user:{uid}:robot:desired",
+              f"user:{uid}:robot:audit"],
+        args=[command, time.time(), COMMAND_STREAM_LEN, AUDIT_STREAM_LEN, uid],
+        client=conn,
+    )
+    return cmd_id.decode() if isinstance(cmd_id, bytes) else cmd_id
+
+
+def wait_robot_ack(conn, command_id, timeout_ms):
+    """Ждёт подтверждения команды воркером; None, если не дождались."""
+    uid = session["user_id"]
+    res = conn.blpop(f"user:{uid}:robot:ack:{command_id}",
+                     timeout=min(timeout_ms, ACK_WAIT_MAX_MS) / 1000)
+    return res[1].decode() if res else None
+
+
+CHART_MAX_POINTS = 500
+_MIN_BUCKET = 10          # сек — шаг, с которым пишет stats_collector
+_LTTB_OVERSAMPLE = 4      # для LTTB берём из SQL в 4 раза больше корзин
+
+# (разрешение в сек, таблица) — от самой грубой свёртки к сырым данным
+_ROLLUPS = (
+    (86400, "energy_stats_daily"),
+    (3600,  "energy_stats_hourly"),
+    (_MIN_BUCKET, "energy_stats"),
+)
+
+
+def lttb(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets: индексы точек, сохраняющих форму ряда."""
+    n = len(ys)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        return [0, n - 1]       # порог 2 — только концы ряда; меньше не бывает (max_points >= 2)
+
+    every = (n - 2) / (threshold - 2)
+    picked = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        nxt_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[end:nxt_end]) / (nxt_end - end)
+        avg_y = sum(ys[end:nxt_end]) / (nxt_end - end)
+
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a])
+                       - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+    return picked
+
+
+# user:{uid}:telemetry:history — кольцевой буфер воркера, элементы JSON [ts, *поля]
+TELEMETRY_HISTORY_FIELDS = ("temperature", "water", "battery", "sensor1")
+TELEMETRY_HISTORY_POINTS = 300
+
+
+def telemetry_history(conn, uid, field, since=None, max_points=TELEMETRY_HISTORY_POINTS):
+    """Ряд одного поля телеметрии из Redis (без MySQL), прорежённый LTTB."""
+    col = TELEMETRY_HISTORY_FIELDS.index(field) + 1
+    xs, ys = [], []
+    for raw in conn.lrange(f"user:{uid}:telemetry:history", 0, -1):
+        point = json.loads(raw)
+        if (since is None or point[0] >= since) and point[col] is not None:
+            xs.append(point[0])
+            ys.append(point[col])
+    picked = lttb(xs, ys, max_points)
+    return {"field": field,
+            "ts": [xs[i] for i in picked],
+            "values": [ys[i] for i in picked]}
+
+
+def _placeholder_chart():
+    now       = datetime.utcnow()
+    labels    = []
+    generated = []
+    saved     = []
+    for h in range(24):                      # последние 24 ч
+        ts = now - timedelta(hours=23 - h)   # в порядке возрастания
+        labels.append(ts.strftime("%H:%M"))
+        g = round(max(0.0, 0.4 * math.sin((h - 6) * math.pi / 24)), 3)
+        s = round(g * 0.15, 3)               # «сэкономлено» 15 %
+        generated.append(g)
+        saved.append(s)
+    return {
+        "labels": labels,
+        "datasets": [
+            {"label": "Energy Generated (kWh)", "data": generated},
+            {"label": "Energy Saved (kWh)",     "data": saved},
+        ],
+    }
 
 
-def chart_data():
+def chart_data(start=None, end=None, max_points=CHART_MAX_POINTS, downsample=None):
     uid = session["user_id"]
 
+    if start is None or end is None:
+        first, last = db.session.execute(
+            text("""SELECT MIN(recorded_at), MAX(recorded_at)
+                    FROM energy_stats
+                    WHERE user_id = :uid"""),
+            {"uid": uid},
+        ).one()
+        # ── если данных нет, соберём простой «заглушочный» ряд ─────────
+        if first is None:
+            return _placeholder_chart()
+        start = start or first
+        end   = end or last + timedelta(seconds=1)
+
+    # ── агрегируем в SQL: не больше max_points корзин на любой диапазон ─
+    points = max_points * _LTTB_OVERSAMPLE if downsample == "lttb" else max_points
+    bucket = max(_MIN_BUCKET, math.ceil((end - start).total_seconds() / points))
+
+    # самая грубая свёртка, которая ещё даёт нужный шаг; корзины кратны её разрешению
+    resolution, table = next(r for r in _ROLLUPS if r[0] <= bucket)
+    bucket = math.ceil(bucket / resolution) * resolution
+    if resolution > _MIN_BUCKET:
+        start = datetime.fromtimestamp(
+            start.replace(tzinfo=timezone.utc).timestamp() // resolution * resolution,
+            timezone.utc).replace(tzinfo=None)
+
     rows = db.session.execute(
-        text("""SELECT recorded_at,
-                       energy_generated_kwh,
-                       energy_saved_kwh
-                FROM energy_stats
+        text(f"""SELECT TIMESTAMPDIFF(SECOND, :start, recorded_at) DIV :bucket AS n,
+                       SUM(energy_generated_kwh),
+                       SUM(energy_saved_kwh)
+                FROM {table}
                 WHERE user_id = :uid
-                ORDER BY recorded_at"""),
-        {"uid": uid},
+                  AND recorded_at >= :start AND recorded_at < :end
+                GROUP BY n
+                ORDER BY n"""),
+        {"uid": uid, "start": start, "end": end, "bucket": bucket},
     ).all()
 
-    # ── если данных нет, соберём простой «заглушочный» ряд ─────────────
-    if not rows:
-        now       = datetime.utcnow()
-        labels    = []
-        generated = []
-        saved     = []
-        for h in range(24):                      # последние 24 ч
-            ts = now - timedelta(hours=23 - h)   # в порядке возрастания
-            labels.append(ts.strftime("%H:%M"))
-            g = round(max(0.0, 0.4 * math.sin((h - 6) * math.pi / 24)), 3)
-            s = round(g * 0.15, 3)               # «сэкономлено» 15 %
-            generated.append(g)
-            saved.append(s)
-        return {
-            "labels": labels,
-            "datasets": [
-                {"label": "Energy Generated (kWh)", "data": generated},
-                {"label": "Energy Saved (kWh)",     "data": saved},
-            ],
-        }
-
-    # ── обычный путь, если реальные записи есть ───────────────────────
+    # номер корзины → datetime здесь: DATE_ADD от параметра-строки вернул бы строку
     labels, generated, saved = [], [], []
-    for recorded_at, gen_kwh, saved_kwh in rows:
-        labels.append(recorded_at.strftime("%Y-%m-%d %H:%M"))
+    for n, gen_kwh, saved_kwh in rows:
+        labels.append(start + timedelta(seconds=int(n) * bucket))
         generated.append(float(gen_kwh))
         saved.append(float(saved_kwh))
 
+    if downsample == "lttb":
+        xs = [ts.timestamp() for ts in labels]
+        keep = lttb(xs, generated, max_points)
+        labels    = [labels[i] for i in keep]
+        generated = [generated[i] for i in keep]
+        saved     = [saved[i] for i in keep]
+
     return {
-        "labels": labels,
+        "labels": [ts.strftime("%Y-%m-%d %H:%M") for ts in labels],
         "datasets": [
             {"label": "Energy Generated (kWh)", "data": generated},
             {"label": "Energy Saved (kWh)",     "data": saved},
         ],
-    }
\ No newline at end of file
+    }
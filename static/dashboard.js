@@ -11,24 +11,29 @@ document.addEventListener("DOMContentLoaded", () => {
             const res = await fetch("/api/settings");
             if (!res.ok) return;
 
-            const s = await res.json();
-            if (s.lat !== null && s.lon !== null) {
-                latInput.value = s.lat;
-                lonInput.value = s.lon;
-                localStorage.setItem("lat", s.lat);
-                localStorage.setItem("lon", s.lon);
-            }
-
+            applySettings(await res.json());
             loadWeather(); // Загружаем погоду после установки координат
         } catch (err) {
             console.error("Ошибка при загрузке настроек:", err);
         }
     }
 
+    function applySettings(s) {
+        if (s.lat !== null && s.lon !== null) {
+            latInput.value = s.lat;
+            lonInput.value = s.lon;
+            localStorage.setItem("lat", s.lat);
+            localStorage.setItem("lon", s.lon);
+        }
+    }
+
     async function loadChartData() {
-        const res = await fetch("/api/chart-data");
+        const res = await fetch("/api/chart-data?max_points=300&downsample=lttb");
         if (!res.ok) return;
-        const data = await res.json();
+        renderChart(await res.json());
+    }
+
+    function renderChart(data) {
         if (energyChart) {
             energyChart.data.labels = data.labels;
             data.datasets.forEach((d, i) => {
@@ -61,12 +66,20 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    function currentLocation() {
+        return [latInput.value || localStorage.getItem("lat") || "50.4501",
+                lonInput.value || localStorage.getItem("lon") || "30.5234"];
+    }
+
     async function loadWeather() {
-        const lat = latInput.value || localStorage.getItem("lat") || "50.4501";
-        const lon = lonInput.value || localStorage.getItem("lon") || "30.5234";
-        const res = await fetch(`/api/weather?lat=${lat}&lon=${lon}`);
+        const [lat, lon] = currentLocation();
+        const res = await fetch(`/api/weather?lat=${lat}&lon=${lon}&step=3&hours=24`);
         if (!res.ok) return;
-        const data = await res.json();
+        renderWeather(await res.json());
+    }
+
+    function renderWeather(data) {
+        const [lat, lon] = currentLocation();
         const list = document.getElementById("weatherList");
         list.innerHTML = "";
 
@@ -76,7 +89,7 @@ document.addEventListener("DOMContentLoaded", () => {
         list.appendChild(header);
 
         const { time, temperature_2m, precipitation_probability } = data.hourly;
-        for (let i = 0; i < time.length; i += 3) {
+        for (let i = 0; i < time.length; i++) {
             const li = document.createElement("li");
             li.className = "list-group-item d-flex justify-content-between";
             const t = new Date(time[i]);
@@ -85,7 +98,6 @@ document.addEventListener("DOMContentLoaded", () => {
                 <span>${temperature_2m[i]}°C</span>
                 <span>${precipitation_probability[i]}%</span>`;
             list.appendChild(li);
-            if (i >= 21) break;
         }
     }
 
@@ -111,6 +123,7 @@ document.addEventListener("DOMContentLoaded", () => {
                         "Content-Type": "application/json",
                         "Accept": "application/json"
                     },
+                    // без wait_ms: ответ сразу после записи в поток, поток Flask не ждёт робота
                     body: JSON.stringify({ command: cmd })
                 });
 
@@ -145,13 +158,15 @@ document.addEventListener("DOMContentLoaded", () => {
         loadWeather();
     });
 
+    function renderBestTime(d) {
+        document.getElementById("plan-result").textContent =
+          `Рекомендовано: ${d.best_time}`;
+    }
+
     document.getElementById("plan-btn").addEventListener("click", () => {
         fetch("/api/best_cleaning_time")
           .then(r => r.json())
-          .then(d => {
-            document.getElementById("plan-result").textContent =
-              `Рекомендовано: ${d.best_time}`;
-          })
+          .then(renderBestTime)
         .catch(() => alert("Не вдалося отримати рекомендацію"));
     });
 
@@ -169,85 +184,122 @@ document.addEventListener("DOMContentLoaded", () => {
         plugins:{legend:{display:false}, tooltip:{enabled:false}}
     }});
 
-    async function pollBattery(){
-        // console.log("pollBattery called");
-        // 1)  Узнаём активен ли сервис робота
-        const svc = await fetch("/api/pipeline", {
-            method:"POST",
-            headers:{"Content-Type":"application/json"},
-            body:JSON.stringify({action:"status"})
-        }).then(r=>r.ok ? r.json() : {status:"inactive"});
-
-        let value = 100;
-        if (svc.status === "running") {
-            // 2)  Берём реальное значение из Redis
-            const res = await fetch("/api/telemetry");
-            if (res.ok) value = (await res.json()).battery;
-        }
-        // 3)  Обновляем чартик
+    function renderBattery(value){
         battChart.data.datasets[0].data = [100 - value, value];
         battChart.update();
         battLbl.textContent = `${Math.round(value)}%`;
     }
-    setInterval(pollBattery, 3000);   // опрос каждые 3 с
-    pollBattery();                    // первый вызов сразу
     // ---------- конец батареи ----------
 
+    function logItem(r) {
+        const li = document.createElement("li");
+        li.className = "list-group-item d-flex justify-content-between gap-2";
+        li.innerHTML = `
+          <span class="text-muted">${r.ts}</span>
+          <span class="badge bg-${r.lvl === "ERROR" ? "danger" :
+                                  r.lvl === "WARN"  ? "warning" : "secondary"}">
+                ${r.lvl}</span>
+          <span class="flex-grow-1 text-truncate">${r.comp}: ${r.msg}</span>`;
+        return li;
+    }
+
+    let lastLogId = 0;
+    let logLoaded = false;      // до первой загрузки since_id=0 вернул бы самые старые записи
+
     async function loadLog() {
         const res = await fetch("/api/event-log");
         if (!res.ok) return;
-        const data = await res.json();
+        renderLog(await res.json());
+    }
 
+    function renderLog(data) {
         const list = document.getElementById("logList");
         list.innerHTML = "";
-        data.forEach(r => {
-            const li = document.createElement("li");
-            li.className = "list-group-item d-flex justify-content-between gap-2";
-            li.innerHTML = `
-              <span class="text-muted">${r.ts}</span>
-              <span class="badge bg-${r.lvl === "ERROR" ? "danger" :
-                                      r.lvl === "WARN"  ? "warning" : "secondary"}">
-                    ${r.lvl}</span>
-              <span class="flex-grow-1 text-truncate">${r.comp}: ${r.msg}</span>`;
-            list.appendChild(li);
-        });
+        data.forEach(r => list.appendChild(logItem(r)));
+        if (data.length) lastLogId = Math.max(lastLogId, data[0].id);
+        logLoaded = true;
+    }
+
+    // только новые записи (после lastLogId), сверху списка
+    async function loadNewLogs() {
+        if (!logLoaded) return;
+        const res = await fetch(`/api/event-log?since_id=${lastLogId}`);
+        if (!res.ok) return;
+        // ответ мог обогнать renderLog/другой loadNewLogs — берём только то, чего ещё нет
+        const data = (await res.json()).filter(r => r.id > lastLogId);
+        if (!data.length) return;
+
+        const list = document.getElementById("logList");
+        data.slice().reverse().forEach(r => list.prepend(logItem(r)));
+        while (list.children.length > 100) list.lastChild.remove();
+        lastLogId = data[0].id;
     }
 
     document.getElementById("refreshLog").addEventListener("click", loadLog);
-    loadLog();    // первый вызов
 
-    async function updateCleanStatus() {
+    function renderCleanStatus(value) {
         const cleanStatusEl = document.getElementById("cleanStatus");
+        if (value === "Clean") {
+            cleanStatusEl.style.backgroundColor = "rgba(30, 144, 255, 0.6)";  // синий
+            cleanStatusEl.textContent = "Clean";
+        } else if (value === "G") {
+            cleanStatusEl.style.backgroundColor = "rgba(220, 53, 69, 0.6)";   // красный
+            cleanStatusEl.textContent = "Dirty";
+        } else {
+            cleanStatusEl.style.backgroundColor = "rgba(0,0,0,0.45)";
+            cleanStatusEl.textContent = value;
+        }
+    }
 
-        const svc = await fetch("/api/pipeline", {
-            method:"POST",
-            headers:{"Content-Type":"application/json"},
-            body:JSON.stringify({action:"status"})
-        }).then(r=>r.ok ? r.json() : {status:"inactive"});
-
-        let value = "--";
-        if (svc.status === "running") {
-            // 2)  Берём реальное значение из Redis
-            const res = await fetch("/api/telemetry");
-            if (res.ok) value = (await res.json()).panelStatus;
-            if (value === "Clean") {
-                cleanStatusEl.style.backgroundColor = "rgba(30, 144, 255, 0.6)";  // синий
-                cleanStatusEl.textContent = "Clean";
-            } else if (value === "G") {
-                cleanStatusEl.style.backgroundColor = "rgba(220, 53, 69, 0.6)";   // красный
-                cleanStatusEl.textContent = "Dirty";
-            } else {
-                cleanStatusEl.style.backgroundColor = "rgba(0,0,0,0.45)";
-                cleanStatusEl.textContent = value;
-            }
+    // ---------- push-обновления (SSE) вместо таймеров ----------
+    let pipelineStatus = "inactive";
+    const telemetry    = {};
+
+    function renderTelemetry() {
+        if (pipelineStatus !== "running") {
+            renderBattery(100);
+            return;
         }
+        renderBattery(telemetry.battery ?? 100);
+        renderCleanStatus(telemetry.panelStatus ?? "--");
     }
 
-    updateCleanStatus();                // первый вызов
-    setInterval(updateCleanStatus, 1000);  // повторять каждые 5 сек
+    const events = new EventSource("/api/events");
+    events.addEventListener("pipeline", e => {
+        pipelineStatus = JSON.parse(e.data).status;
+        renderTelemetry();
+    });
+    events.addEventListener("telemetry", e => {
+        Object.assign(telemetry, JSON.parse(e.data));
+        renderTelemetry();
+    });
+    events.addEventListener("log", loadNewLogs);
+    events.addEventListener("open", loadNewLogs);   // после переподключения дочитываем пропущенное
 
+    // Инициализация: всё начальное состояние одним запросом (с ETag — повторно 304)
+    async function loadDashboardState() {
+        let state;
+        try {
+            const res = await fetch("/api/dashboard-state");
+            if (!res.ok) throw new Error(`HTTP ${res.status}`);
+            state = await res.json();
+        } catch (err) {
+            // по частям — как раньше
+            console.error("Ошибка при загрузке состояния дашборда:", err);
+            initSettings();
+            loadChartData();
+            loadLog();
+            return;
+        }
+        applySettings(state.settings);
+        renderWeather(state.weather);
+        renderChart(state.chart);
+        renderBestTime(state.best_time);
+        renderLog(state.event_log);
+        pipelineStatus = state.pipeline.status;
+        Object.assign(telemetry, state.telemetry);
+        renderTelemetry();
+    }
 
-    // Инициализация
-    initSettings();
-    loadChartData();
+    loadDashboardState();
 });
@@ -1,5 +1,10 @@
+from collections import defaultdict
 from datetime import datetime, timezone
+import argparse
+import os
+import socket
 import time
+import zlib
 import redis
 from sqlalchemy import create_engine, text
 from config import Config
@@ -16,34 +21,249 @@ def f(x):
 ROUND   = 6
 INTERVAL = 10
 
-while True:
-    for k in redis_conn.scan_iter("telemetry:*"):
-        t = redis_conn.hgetall(k)
-        if not t:
-            continue
+# сырые 10-секундные строки и их почасовые/суточные свёртки
+ROLLUPS = (
+    ("energy_stats",        lambda ts: ts),
+    ("energy_stats_hourly", lambda ts: ts.replace(minute=0, second=0)),
+    ("energy_stats_daily",  lambda ts: ts.replace(hour=0, minute=0, second=0)),
+)
+
+def upsert(c, rows):
+    """Добавляет выработку в сырую таблицу и во все свёртки одним executemany на таблицу."""
+    for table, bucket in ROLLUPS:
+        c.execute(
+            text(
+                f"INSERT INTO {table} "
+                "(user_id, recorded_at, energy_generated_kwh, energy_saved_kwh) "
+                "VALUES (:uid, :ts, :g, :s) "
+                "ON DUPLICATE KEY UPDATE "
+                "energy_generated_kwh = energy_generated_kwh + VALUES(energy_generated_kwh), "
+                "energy_saved_kwh     = energy_saved_kwh     + VALUES(energy_saved_kwh)"
+            ),
+            [{**r, "ts": bucket(r["ts"])} for r in rows],
+        )
+
+def backfill_rollups():
+    """Пересчитывает свёртки из energy_stats (однократно после миграции)."""
+    with engine.begin() as c:
+        for table, fmt in (("energy_stats_hourly", "%Y-%m-%d %H:00:00"),
+                           ("energy_stats_daily",  "%Y-%m-%d 00:00:00")):
+            c.execute(text(
+                f"REPLACE INTO {table} "
+                "(user_id, recorded_at, energy_generated_kwh, energy_saved_kwh) "
+                f"SELECT user_id, DATE_FORMAT(recorded_at, '{fmt}') AS bucket, "
+                "SUM(energy_generated_kwh), SUM(energy_saved_kwh) "
+                "FROM energy_stats GROUP BY user_id, bucket"
+            ))
+
+CYCLE_KEY = "stats_collector:cycle"     # тайминги последнего цикла для мониторинга
+
+# Воркеры при каждой записи телеметрии делают ZADD robots:active {user_id: now}
+ACTIVE_KEY    = "robots:active"
+ACTIVE_WINDOW = 15 * 60            # сек: хвост потока может быть старше одного цикла
+PRUNE_AFTER   = 24 * 3600          # сек: после этого запись удаляется из реестра
+
+# Каждая строка Arduino лежит в user:{uid}:telemetry:stream (sensor1 — мощность, dt — её длительность).
+# Несколько коллекторов читают потоки одной consumer group и делят записи между собой.
+GROUP         = "stats_collector"
+CONSUMER      = f"{socket.gethostname()}-{os.getpid()}"
+BATCH         = 500                # записей на поток за один XREADGROUP
+MAX_ROUNDS    = 10                 # XREADGROUP подряд за цикл, чтобы не выйти за INTERVAL
+STREAMS_PER_READ = 256
+CLAIM_IDLE_MS = 60_000             # чужие неподтверждённые записи забираем через минуту
+CLAIM_EVERY   = 6                  # циклов между XAUTOCLAIM
+
+# Шардирование: коллектор с --shard i --shards n берёт только user_id, у которых
+# crc32(user_id) % n == i. SET stats_collector:shards <n> меняет n на лету у всех
+# запущенных коллекторов; записи, прочитанные, но не подтверждённые при смене,
+# остаются в consumer group и не будут учтены дважды.
+SHARDS_KEY = "stats_collector:shards"
+
+# Каждый коллектор в начале цикла отмечает свой шард в LIVE_KEY. Шард без живого
+# коллектора (n подняли, а коллектор не запустили или он упал) подхватывает один из
+# живых — иначе потоки его роботов упрутся в MAXLEN и энергия молча потеряется.
+# Двойного учёта нет: записи делит consumer group.
+LIVE_KEY     = "stats_collector:live"
+LIVE_TIMEOUT = 3 * INTERVAL        # сек без цикла — коллектор шарда считается мёртвым
+
+def in_shard(uid, owned, shards):
+    return zlib.crc32(str(uid).encode()) % shards in owned
+
+def owned_shards(shard, shards):
+    """(шарды этого коллектора, шарды без живого коллектора)."""
+    now  = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.zadd(LIVE_KEY, {shard: now})
+    pipe.zremrangebyscore(LIVE_KEY, "-inf", now - PRUNE_AFTER)
+    pipe.zrangebyscore(LIVE_KEY, now - LIVE_TIMEOUT, "+inf")
+    _, _, members = pipe.execute()
+    live = sorted({int(m) for m in members if int(m) < shards})
+    orphans = [s for s in range(shards) if s not in live]
+    # сироты делятся между живыми детерминированно: все коллекторы считают одинаково
+    owned = {shard} | {o for i, o in enumerate(orphans) if live[i % len(live)] == shard}
+    return owned, orphans
+
+def current_shards(default):
+    value = redis_conn.get(SHARDS_KEY)
+    try:
+        return max(1, int(value)) if value else default
+    except ValueError:
+        return default
+
+def stream_key(uid):
+    return f"user:{uid}:telemetry:stream"
+
+def active_robots():
+    now  = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.zremrangebyscore(ACTIVE_KEY, "-inf", now - PRUNE_AFTER)
+    pipe.zrangebyscore(ACTIVE_KEY, now - ACTIVE_WINDOW, "+inf")
+    _, members = pipe.execute()
+    ids = []
+    for m in members:
+        try:
+            ids.append(int(m))
+        except ValueError:
+            continue                # демо-воркеры без числового user_id
+    return ids
 
-        user_id = int(t.get("user_id", 0))
-        if not user_id:
+_groups: set[int] = set()
+
+def ensure_groups(user_ids):
+    new = [uid for uid in user_ids if uid not in _groups]
+    if not new:
+        return
+    pipe = redis_conn.pipeline(transaction=False)
+    for uid in new:
+        pipe.xgroup_create(stream_key(uid), GROUP, id="0", mkstream=True)
+    for uid, res in zip(new, pipe.execute(raise_on_error=False)):
+        if isinstance(res, Exception) and "BUSYGROUP" not in str(res):
             continue
+        _groups.add(uid)
+
+def read_entries(user_ids, claim):
+    """[(user_id, entry_id, fields)]: новые записи и, если claim, зависшие у упавших коллекторов."""
+    entries = []
+    if claim and user_ids:
+        pipe = redis_conn.pipeline(transaction=False)
+        for uid in user_ids:
+            pipe.xautoclaim(stream_key(uid), GROUP, CONSUMER, CLAIM_IDLE_MS, "0-0", count=BATCH)
+        for uid, res in zip(user_ids, pipe.execute()):
+            entries += [(uid, eid, fields) for eid, fields in res[1] if fields]
+
+    for i in range(0, len(user_ids), STREAMS_PER_READ):
+        streams = {stream_key(uid): ">" for uid in user_ids[i:i + STREAMS_PER_READ]}
+        for _ in range(MAX_ROUNDS):
+            resp = redis_conn.xreadgroup(GROUP, CONSUMER, streams, count=BATCH)
+            for stream, msgs in resp:
+                uid = int(stream.split(":")[1])
+                entries += [(uid, eid, fields) for eid, fields in msgs]
+            if all(len(msgs) < BATCH for _, msgs in resp):
+                break
+    return entries
+
+def collect(owned=(0,), shards=1, claim=False):
+    """Один цикл: вычитать потоки, проинтегрировать каждую строку, upsert + XACK.
 
-        p_watt = f(t.get("sensor1"))
-        gen = round(p_watt / 1000 * INTERVAL / 3600, ROUND)
+    Энергия строки = sensor1 * dt; 10-секундная корзина берётся по времени
+    самой записи (id потока), поэтому опоздавшие строки попадают в свой интервал.
+    """
+    user_ids = [uid for uid in active_robots() if in_shard(uid, owned, shards)]
+    ensure_groups(user_ids)
+    entries = read_entries(user_ids, claim)
+
+    energy = defaultdict(float)
+    for uid, eid, fields in entries:
+        kwh = f(fields.get("sensor1")) * f(fields.get("dt")) / 1000 / 3600
+        if kwh:
+            bucket = int(eid.split("-")[0]) // 1000 // INTERVAL * INTERVAL
+            energy[uid, bucket] += kwh
+
+    rows = []
+    for (uid, bucket), kwh in energy.items():
+        gen = round(kwh, ROUND)
         if not gen:
             continue
-
         sav = round(gen * 0.15, ROUND)
-        ts  = datetime.now(timezone.utc).replace(microsecond=0)
+        ts  = datetime.fromtimestamp(bucket, timezone.utc)
+        rows.append({"uid": uid, "ts": ts, "g": gen, "s": sav})
 
+    if rows:
         with engine.begin() as c:
-            c.execute(
-                text(
-                    "INSERT INTO energy_stats "
-                    "(user_id, recorded_at, energy_generated_kwh, energy_saved_kwh) "
-                    "VALUES (:uid, :ts, :g, :s) "
-                    "ON DUPLICATE KEY UPDATE "
-                    "energy_generated_kwh = energy_generated_kwh + :g, "
-                    "energy_saved_kwh     = energy_saved_kwh     + :s"
-                ),
-                {"uid": user_id, "ts": ts, "g": gen, "s": sav},
-            )
-    time.sleep(INTERVAL)
\ No newline at end of file
+            upsert(c, rows)
+
+    # подтверждаем только после commit: при падении записи заберёт другой коллектор
+    if entries:
+        acks = defaultdict(list)
+        for uid, eid, _ in entries:
+            acks[uid].append(eid)
+        pipe = redis_conn.pipeline(transaction=False)
+        for uid, ids in acks.items():
+            pipe.xack(stream_key(uid), GROUP, *ids)
+        pipe.execute()
+    return len(user_ids), len(entries), len(rows)
+
+def main(shard=0, shards=1):
+    cycle_key = f"{CYCLE_KEY}:{shard}"
+    # циклы идут по фиксированной сетке INTERVAL; долгий цикл не сдвигает сетку
+    next_tick = time.time() // INTERVAL * INTERVAL + INTERVAL
+    cycle = 0
+    last_orphans = []
+    while True:
+        time.sleep(max(0.0, next_tick - time.time()))
+        n = current_shards(shards)
+        if n != shards:
+            print(f"[stats_collector] rebalance: {shards} -> {n} shards")
+            shards = n
+        if shard >= shards:
+            # этого шарда больше нет — ждём, пока число шардов снова вырастет
+            next_tick += INTERVAL
+            continue
+
+        owned, orphans = owned_shards(shard, shards)
+        if orphans != last_orphans:
+            if orphans:
+                print(f"[stats_collector] no live collector for shard(s) {orphans}, "
+                      f"this one takes {sorted(owned - {shard}) or 'none'}")
+            last_orphans = orphans
+
+        started = time.monotonic()
+        robots, samples, written = collect(owned, shards,
+                                           claim=cycle % CLAIM_EVERY == 0)
+        duration = time.monotonic() - started
+        cycle += 1
+
+        next_tick += INTERVAL
+        missed = 0
+        while next_tick <= time.time():
+            next_tick += INTERVAL
+            missed += 1
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hset(cycle_key, mapping={
+            "finished_at": int(time.time()),
+            "duration_ms": round(duration * 1000, 1),
+            "shards":      shards,
+            "robots":      robots,
+            "samples":     samples,
+            "rows":        written,
+            "missed":      missed,
+            "orphaned":    ",".join(map(str, orphans)),
+        })
+        if missed:
+            pipe.hincrby(cycle_key, "overruns", 1)
+            print(f"[stats_collector] cycle took {duration:.1f}s, skipped {missed} tick(s)")
+        pipe.execute()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Energy stats collector")
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--backfill", action="store_true",
+                        help="пересчитать почасовые/суточные свёртки и выйти")
+    args = parser.parse_args()
+    if args.backfill:
+        backfill_rollups()
+    elif not 0 <= args.shard < args.shards:
+        parser.error("--shard must be in [0, --shards)")
+    else:
+        main(args.shard, args.shards)
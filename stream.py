@@ -1,5 +1,7 @@
 import time
 import base64
+import struct
+import threading
 import redis
 from flask import Blueprint, Response, session
 from config import Config
@@ -9,6 +11,12 @@ redis_conn = redis.from_url(Config.REDIS_URL, ssl_cert_reqs=None)
 
 _BOUNDARY = b"--frame\r\n"
 _HEADERS = b"Content-Type: image/jpeg\r\n\r\n"
+_POLL = 0.05          # период опроса Redis одним читателем на пользователя
+_IDLE_WAIT = 5.0      # зритель ждёт кадр не дольше, потом проверяет соединение
+
+# Бинарная запись кадра от воркера (см. core.redis_processor.send_frame)
+_FRAME_MAGIC = b"RBF1"
+_FRAME_HEADER = struct.Struct("!4sQd")   # magic, seq, capture ts
 
 
 def _decode(payload: bytes) -> bytes | None:
@@ -31,6 +39,88 @@ def _decode(payload: bytes) -> bytes | None:
         return None
 
 
+class _FrameBroadcaster:
+    """Один читатель Redis на пользователя; готовый multipart-чанк делится между всеми зрителями."""
+
+    def __init__(self, uid):
+        self.keys = (f"user:{uid}:frame", f"user:{uid}:video")
+        self.uid = uid
+        self.viewers = 0
+        self.seq = 0
+        self.chunk = None
+        self._raw = None
+        self._frame_seq = None
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _read(self):
+        for key in self.keys:
+            # сначала только заголовок: уже отправленный кадр не тянем целиком
+            head = redis_conn.getrange(key, 0, _FRAME_HEADER.size - 1)
+            if not head:
+                continue
+            if len(head) == _FRAME_HEADER.size and head[:4] == _FRAME_MAGIC:
+                if _FRAME_HEADER.unpack(head)[1] == self._frame_seq:
+                    return None
+                data = redis_conn.get(key)
+                if not data or len(data) <= _FRAME_HEADER.size:
+                    continue
+                self._frame_seq = _FRAME_HEADER.unpack_from(data)[1]
+                frame = memoryview(data)[_FRAME_HEADER.size:]
+                return b"".join((_BOUNDARY, _HEADERS, frame, b"\r\n"))
+
+            # старый текстовый формат "1_<base64>_endframe"
+            data = redis_conn.get(key)
+            if not data:
+                continue
+            if data == self._raw:
+                return None
+            frame = _decode(data)
+            if frame:
+                self._raw = data
+                return _BOUNDARY + _HEADERS + frame + b"\r\n"
+        return None
+
+    def _run(self):
+        while True:
+            with _lock:
+                if not self.viewers:
+                    if _broadcasters.get(self.uid) is self:
+                        del _broadcasters[self.uid]
+                    return
+            chunk = self._read()
+            if chunk:
+                with self._cond:
+                    self.chunk = chunk
+                    self.seq += 1
+                    self._cond.notify_all()
+            time.sleep(_POLL)
+
+    def wait(self, seen: int):
+        """Блокирует зрителя до кадра новее `seen`; возвращает (seq, chunk)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq != seen, timeout=_IDLE_WAIT)
+            return self.seq, self.chunk
+
+
+_broadcasters: dict = {}
+_lock = threading.Lock()
+
+
+def _attach(uid) -> _FrameBroadcaster:
+    with _lock:
+        bc = _broadcasters.get(uid)
+        if bc is None:
+            bc = _broadcasters[uid] = _FrameBroadcaster(uid)
+        bc.viewers += 1
+    return bc
+
+
+def _detach(bc: _FrameBroadcaster) -> None:
+    with _lock:
+        bc.viewers -= 1
+
+
 @bp.route("/video_feed")
 def video_feed():
     uid = session.get("user_id")
@@ -38,17 +128,17 @@ def video_feed():
         return Response(status=403)
 
     def _gen(uid):
-        keys = (f"user:{uid}:frame", f"user:{uid}:video")
-        while True:
-            frame = None
-            for key in keys:
-                data = redis_conn.get(key)
-                if data:
-                    frame = _decode(data)
-                    if frame:
-                        break
-            if frame:
-                yield _BOUNDARY + _HEADERS + frame + b"\r\n"
-            time.sleep(0.05)
+        bc = _attach(uid)
+        seen = 0
+        try:
+            while True:
+                seq, chunk = bc.wait(seen)
+                if chunk is None:
+                    continue
+                # повтор по таймауту — заодно проверка, что зритель ещё подключён
+                seen = seq
+                yield chunk
+        finally:
+            _detach(bc)
 
     return Response(_gen(uid), mimetype="multipart/x-mixed-replace; boundary=frame")
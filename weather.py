@@ -0,0 +1,261 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config
+
+redis_conn = redis.from_url(Config.REDIS_URL, ssl_cert_reqs=None)
+
+GRID       = 0.1           # градусы (~11 км): один прогноз на клетку для всех пользователей
+TTL        = 30 * 60       # сек: прогноз свежий
+STALE_TTL  = 6 * 3600      # сек: после TTL ещё отдаём, пока обновляется в фоне
+LOCAL_SIZE = 1024          # клеток в памяти процесса
+LOCK_TTL   = 10            # сек: сколько держится блокировка обновления клетки
+LOCK_WAIT  = 5             # сек: сколько ждём чужого обновления, прежде чем идти сами
+
+# Клетки, которые кто-то запрашивал, и время их последней загрузки —
+# по ним weather_refresher.py обновляет прогнозы до истечения TTL.
+ACTIVE_KEY     = "weather:active"
+FETCHED_KEY    = "weather:fetched"
+ACTIVE_WINDOW  = 24 * 3600  # сек: клетку без запросов дольше перестаём обновлять
+TOUCH_EVERY    = 5 * 60     # сек: не чаще отмечаем клетку активной из одного процесса
+REFRESH_MARGIN = 5 * 60     # сек: обновляем за столько до истечения TTL
+BATCH_SIZE     = 50         # клеток в одном upstream-запросе (API принимает списки координат)
+
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+def cell(lat, lon) -> tuple[float, float]:
+    """Квантует координаты до центра клетки сетки GRID."""
+    return (round(round(float(lat) / GRID) * GRID, 4),
+            round(round(float(lon) / GRID) * GRID, 4))
+
+
+def _member(c) -> str:
+    return f"{c[0]:.4f}:{c[1]:.4f}"
+
+
+def _key(c) -> str:
+    return f"weather:{_member(c)}"
+
+
+class _LRU:
+    """Маленький потокобезопасный LRU с истечением записей."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._items[key] = (expires_at, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+_local = _LRU(LOCAL_SIZE)
+_flights: dict[str, threading.Lock] = {}
+_flights_lock = threading.Lock()
+_touched: dict[str, float] = {}
+
+
+def _flight(key) -> threading.Lock:
+    with _flights_lock:
+        return _flights.setdefault(key, threading.Lock())
+
+
+def _touch(c) -> None:
+    member = _member(c)
+    now = time.time()
+    if now - _touched.get(member, 0) < TOUCH_EVERY:
+        return
+    _touched[member] = now
+    redis_conn.zadd(ACTIVE_KEY, {member: now})
+
+
+def _fetch_many(cells) -> list[dict]:
+    """Один upstream-запрос на несколько клеток: lat/lon уходят списками через запятую."""
+    url = Config.WEATHER_API_URL.format(lat=",".join(f"{c[0]:.4f}" for c in cells),
+                                        lon=",".join(f"{c[1]:.4f}" for c in cells))
+    params = {"apikey": Config.WEATHER_API_KEY} if Config.WEATHER_API_KEY else {}
+    resp = _http.get(url, params=params, timeout=10)
+    resp.raise_for_status()
+    data = resp.json()
+    # на одну точку API отвечает объектом, на несколько — списком в том же порядке
+    data = data if isinstance(data, list) else [data]
+    if len(data) != len(cells):
+        raise ValueError(f"expected {len(cells)} forecasts, got {len(data)}")
+    # тело ошибки в кэш не попадает — иначе его отдавали бы всем пользователям клетки
+    if not all(isinstance(d, dict) and isinstance(d.get("hourly"), dict) for d in data):
+        raise ValueError("forecast without 'hourly' data")
+    return data
+
+
+# Дашборду нужны только эти ряды; проекция строится один раз при заполнении кэша
+PROJECTED = ("time", "temperature_2m", "precipitation_probability")
+# (step, hours), которые хранятся в записи кэша: полный ряд и вид dashboard.js.
+# Остальные строятся на лету — иначе любой клиент раздувал бы память перебором параметров
+CACHED_VIEWS = {(1, None), (3, 24)}
+
+
+def _project(data, step=1, hours=None) -> bytes:
+    hourly = data.get("hourly") or {}
+    cols = {name: (hourly.get(name) or [])[:hours][::step] for name in PROJECTED}
+    return json.dumps({"hourly": cols}, separators=(",", ":")).encode()
+
+
+def _remember(key, entry) -> dict:
+    entry["views"] = {(1, None): _project(entry["data"])}
+    _local.set(key, entry, entry["fetched_at"] + STALE_TTL)
+    return entry
+
+
+def _from_redis(key):
+    raw = redis_conn.get(key)
+    return _remember(key, json.loads(raw)) if raw else None
+
+
+def _store(cells, forecasts) -> list[dict]:
+    now = time.time()
+    entries = [{"fetched_at": now, "data": data} for data in forecasts]
+    pipe = redis_conn.pipeline(transaction=False)
+    for c, entry in zip(cells, entries):
+        pipe.set(_key(c), json.dumps({"fetched_at": now, "data": entry["data"]}), ex=STALE_TTL)
+    pipe.zadd(FETCHED_KEY, {_member(c): now for c in cells})
+    pipe.execute()
+    return [_remember(_key(c), entry) for c, entry in zip(cells, entries)]
+
+
+def _refresh(c) -> dict:
+    return _store([c], _fetch_many([c]))[0]
+
+
+def _try_refresh(c, key):
+    """Обновляет клетку, если никто другой этим сейчас не занят; иначе None."""
+    lock = f"{key}:lock"
+    if not redis_conn.set(lock, 1, nx=True, ex=LOCK_TTL):
+        return None
+    try:
+        return _refresh(c)
+    finally:
+        redis_conn.delete(lock)
+
+
+def _revalidate(c, key) -> None:
+    try:
+        # refresher или другой процесс мог уже обновить клетку — тогда upstream не нужен
+        entry = _from_redis(key)
+        if entry is None or time.time() - entry["fetched_at"] > TTL:
+            _try_refresh(c, key)
+    except Exception:
+        pass                    # останется устаревший прогноз, повторим позже
+    finally:
+        _flight(key).release()
+
+
+def forecast(lat, lon) -> dict:
+    """Прогноз для клетки: память процесса → Redis → upstream (один запрос на клетку).
+
+    Устаревшая (старше TTL) запись отдаётся сразу, а обновляется в фоне.
+    """
+    return _entry(lat, lon)["data"]
+
+
+def forecast_entry(lat, lon) -> dict:
+    """Запись кэша целиком: data, fetched_at (версия прогноза) и производные представления."""
+    return _entry(lat, lon)
+
+
+def forecast_compact(lat, lon, step=1, hours=None) -> bytes:
+    """Готовый JSON {"hourly": {...}} только с рядами PROJECTED, каждый step-й час."""
+    return compact(_entry(lat, lon), step, hours)
+
+
+def compact(entry, step=1, hours=None) -> bytes:
+    """forecast_compact для уже полученной записи кэша (см. forecast_entry)."""
+    view = (step, hours)
+    if view in entry["views"]:
+        return entry["views"][view]
+    data = _project(entry["data"], step, hours)
+    if view in CACHED_VIEWS:
+        entry["views"][view] = data
+    return data
+
+
+def _entry(lat, lon) -> dict:
+    c = cell(lat, lon)
+    key = _key(c)
+    _touch(c)
+    entry = _local.get(key) or _from_redis(key)
+    if entry is not None:
+        stale = time.time() - entry["fetched_at"] > TTL
+        if stale and _flight(key).acquire(blocking=False):
+            threading.Thread(target=_revalidate, args=(c, key), daemon=True).start()
+        return entry
+
+    with _flight(key):                  # single-flight внутри процесса
+        entry = _local.get(key) or _from_redis(key)
+        if entry is None:
+            entry = _try_refresh(c, key)    # ...и между процессами/хостами
+        deadline = time.monotonic() + LOCK_WAIT
+        while entry is None and time.monotonic() < deadline:
+            time.sleep(0.1)
+            entry = _from_redis(key)
+        if entry is None:
+            entry = _refresh(c)
+        return entry
+
+
+def refresh_due() -> int:
+    """Обновляет активные клетки, которым скоро истекать, пачками по BATCH_SIZE.
+
+    Возвращает число обновлённых клеток.
+    """
+    now = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.zremrangebyscore(ACTIVE_KEY, "-inf", now - ACTIVE_WINDOW)
+    pipe.zrange(ACTIVE_KEY, 0, -1)
+    pipe.zrange(FETCHED_KEY, 0, -1, withscores=True)
+    _, active, fetched = pipe.execute()
+    fetched = dict(fetched)
+
+    due = [tuple(map(float, m.decode().split(":"))) for m in active
+           if fetched.get(m, 0) <= now - TTL + REFRESH_MARGIN]
+
+    refreshed = 0
+    for i in range(0, len(due), BATCH_SIZE):
+        batch = due[i:i + BATCH_SIZE]
+        pipe = redis_conn.pipeline(transaction=False)
+        for c in batch:
+            pipe.set(f"{_key(c)}:lock", 1, nx=True, ex=LOCK_TTL)
+        batch = [c for c, ok in zip(batch, pipe.execute()) if ok]
+        if not batch:
+            continue
+        try:
+            _store(batch, _fetch_many(batch))
+            refreshed += len(batch)
+        except Exception as exc:
+            print(f"[weather] refresh of {len(batch)} cell(s) failed: {exc}")
+        finally:
+            redis_conn.delete(*(f"{_key(c)}:lock" for c in batch))
+    redis_conn.zremrangebyscore(FETCHED_KEY, "-inf", now - STALE_TTL)
+    return refreshed
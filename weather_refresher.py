@@ -0,0 +1,14 @@
+import time
+import weather
+
+INTERVAL = 60
+
+# Держит прогнозы активных клеток свежими, чтобы /api/weather и
+# /api/best_cleaning_time никогда не ждали upstream API.
+while True:
+    started = time.monotonic()
+    refreshed = weather.refresh_due()
+    if refreshed:
+        print(f"[weather_refresher] refreshed {refreshed} cell(s) "
+              f"in {time.monotonic() - started:.1f}s")
+    time.sleep(INTERVAL)